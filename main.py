@@ -1,33 +1,113 @@
 # main.py
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel, HttpUrl
-from typing import List, Optional, Dict
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, ConfigDict, TypeAdapter
+from cachetools import LRUCache, TTLCache
+from collections import defaultdict
+from types import MappingProxyType
+from typing import Any, Awaitable, Callable, Iterable, List, Optional, Dict, Tuple
+import asyncio
+import hashlib
 import httpx
+import itertools
+import logging
+import orjson
 import os
 import re
+import time
 from dotenv import load_dotenv
 
 load_dotenv()
 
-app = FastAPI()
+logger = logging.getLogger(__name__)
 
 SHOPIFY_SHOP_URL = os.getenv("SHOPIFY_SHOP_URL")
 SHOPIFY_ACCESS_TOKEN = os.getenv("SHOPIFY_ACCESS_TOKEN")
 
-
-class Image(BaseModel):
-    src: HttpUrl
+SHOPIFY_HEADERS = MappingProxyType({
+    "X-Shopify-Access-Token": SHOPIFY_ACCESS_TOKEN or "",
+    "Content-Type": "application/json"
+})
+
+# Admin API paths, resolved against SHOPIFY_SHOP_URL by the shared client
+SHOPIFY_API_PATH = "/admin/api/2023-04"
+PRODUCTS_PATH = f"{SHOPIFY_API_PATH}/products.json"
+PRODUCT_PATH = f"{SHOPIFY_API_PATH}/products/{{}}.json"
+INVENTORY_LEVELS_PATH = f"{SHOPIFY_API_PATH}/inventory_levels.json?limit=250&inventory_item_ids={{}}"
+
+# Shopify's REST Admin API bucket holds 40 requests per store and drains
+# 2 per second. Every outbound request is paced against a local copy of
+# that bucket; a 429 that still gets through is retried after Retry-After
+# a few times before the error is passed on.
+SHOPIFY_BUCKET_SIZE = 40
+SHOPIFY_LEAK_RATE = 2
+SHOPIFY_MAX_RETRIES = 3
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # One pooled client for the whole app so connections to Shopify are
+    # reused across requests instead of being re-established every time.
+    # Every call goes to the same shop, so HTTP/2 lets concurrent requests
+    # share a single connection.
+    app.state.http = httpx.AsyncClient(
+        base_url=SHOPIFY_SHOP_URL or "",
+        http2=True,
+        headers=SHOPIFY_HEADERS,
+        limits=httpx.Limits(max_keepalive_connections=50,
+                            keepalive_expiry=60),
+        timeout=httpx.Timeout(10.0))
+    yield
+    await app.state.http.aclose()
+
+
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
+
+# Last 200 response Shopify sent for each recently used URL, replayed when
+# it answers a conditional GET with 304 Not Modified
+etag_cache: LRUCache = LRUCache(maxsize=1_000)
+# Shopify requests currently in flight, keyed by URL
+etag_requests: Dict[str, asyncio.Task] = {}
+
+# Handles don't change for the lifetime of a product, so resolved IDs are
+# kept for a few minutes to save the Shopify round trip
+handle_cache: TTLCache = TTLCache(maxsize=10_000, ttl=300)
+# Handle lookups currently in flight, keyed by handle
+handle_lookups: Dict[str, asyncio.Task] = {}
+
+# Serialized list responses are fresh for RESPONSE_TTL seconds, then served
+# stale for up to RESPONSE_STALE_TTL more while a background refresh runs
+RESPONSE_TTL = 15
+RESPONSE_STALE_TTL = 30
+LIST_CACHE_CONTROL = f"public, max-age={RESPONSE_TTL}, stale-while-revalidate={RESPONSE_STALE_TTL}"
+response_cache: TTLCache = TTLCache(
+    maxsize=128, ttl=RESPONSE_TTL + RESPONSE_STALE_TTL)
+response_locks: Dict[str, asyncio.Lock] = defaultdict(asyncio.Lock)
+response_refreshes: Dict[str, asyncio.Task] = {}
+
+
+class ShopifyModel(BaseModel):
+    # extra="ignore" is already Pydantic's default and is only spelled out
+    # here; frozen=True is the real addition, so models shared across
+    # requests can't be mutated
+    model_config = ConfigDict(extra="ignore", frozen=True)
+
+
+class Image(ShopifyModel):
+    # Shopify always serves valid CDN URLs, so skip parsing each one
+    src: str
     alt: Optional[str] = None
 
 
-class Variant(BaseModel):
+class Variant(ShopifyModel):
     id: int
     title: str
     price: str
     sku: Optional[str] = None
 
 
-class VariantDetails(BaseModel):
+class VariantDetails(ShopifyModel):
     id: int
     title: str
     price: str
@@ -36,7 +116,7 @@ class VariantDetails(BaseModel):
     inventory_quantity: int
 
 
-class ProductDetails(BaseModel):
+class ProductDetails(ShopifyModel):
     id: int
     title: str
     body_html: Optional[str]
@@ -49,7 +129,7 @@ class ProductDetails(BaseModel):
     images: List[Image]
 
 
-class Product(BaseModel):
+class Product(ShopifyModel):
     id: int
     title: str
     body_html: Optional[str]
@@ -62,194 +142,413 @@ class Product(BaseModel):
     images: List[Image]
 
 
-class ProductsResponse(BaseModel):
+class ProductsResponse(ShopifyModel):
     products: List[Product]
 
 
-class DetailedProductsResponse(BaseModel):
+class DetailedProductsResponse(ShopifyModel):
     products: List[ProductDetails]
 
 
+# Validates a whole page of raw product dicts in one call
+product_details_list = TypeAdapter(List[ProductDetails])
+
+
+async def single_flight(in_flight: Dict[str, asyncio.Task], key: str, load: Callable[[], Awaitable[Any]]) -> Any:
+    # Concurrent callers for a key all await the same task. The task drops
+    # out of in_flight when it finishes, so the dict only holds live work.
+    # shield() keeps one cancelled caller from cancelling it for the rest.
+    task = in_flight.get(key)
+    if task is None:
+        task = asyncio.create_task(load())
+        in_flight[key] = task
+        task.add_done_callback(lambda _: in_flight.pop(key, None))
+    return await asyncio.shield(task)
+
+
+class ShopifyBucket:
+    # Tracks how full Shopify's leaky bucket is so requests wait for room
+    # instead of bursting past it. Callers queue on the lock in arrival
+    # order, which spreads them out at the leak rate.
+
+    def __init__(self, size: int, leak_rate: float):
+        self.size = size
+        self.leak_rate = leak_rate
+        self.level = 0.0
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def leak(self) -> None:
+        now = time.monotonic()
+        self.level = max(0.0, self.level - (now - self.updated) * self.leak_rate)
+        self.updated = now
+
+    async def acquire(self) -> None:
+        async with self.lock:
+            self.leak()
+            while self.level + 1 > self.size:
+                await asyncio.sleep((self.level + 1 - self.size) / self.leak_rate)
+                self.leak()
+            self.level += 1
+
+    def observe(self, response: httpx.Response) -> None:
+        # Shopify reports its own view of the bucket as "used/size"; trust
+        # it whenever it is fuller than our estimate
+        self.leak()
+        if response.status_code == 429:
+            self.level = self.size
+            return
+        used, _, _ = response.headers.get(
+            "X-Shopify-Shop-Api-Call-Limit", "").partition("/")
+        if used.isdigit():
+            self.level = max(self.level, float(used))
+
+
+shopify_bucket = ShopifyBucket(SHOPIFY_BUCKET_SIZE, SHOPIFY_LEAK_RATE)
+
+
+async def shopify_get(client: httpx.AsyncClient, url: str, **kwargs: Any) -> httpx.Response:
+    for attempt in range(SHOPIFY_MAX_RETRIES + 1):
+        await shopify_bucket.acquire()
+        response = await client.get(url, **kwargs)
+        shopify_bucket.observe(response)
+        if response.status_code != 429 or attempt == SHOPIFY_MAX_RETRIES:
+            return response
+        await asyncio.sleep(float(response.headers.get("Retry-After", 2.0)))
+
+
+async def revalidate(client: httpx.AsyncClient, url: str) -> httpx.Response:
+    cached = etag_cache.get(url)
+    headers = {}
+    if cached is not None:
+        headers["If-None-Match"] = cached.headers["etag"]
+
+    response = await shopify_get(client, url, headers=headers)
+    if response.status_code == 304 and cached is not None:
+        return cached
+    if response.status_code == 200 and "etag" in response.headers:
+        etag_cache[url] = response
+    return response
+
+
+async def conditional_get(client: httpx.AsyncClient, url: str) -> httpx.Response:
+    return await single_flight(etag_requests, url, lambda: revalidate(client, url))
+
+
+async def refresh_response(key: str, load: Callable[[], Awaitable[BaseModel]]) -> None:
+    try:
+        body = (await load()).model_dump_json().encode()
+    except Exception:
+        # Keep serving the stale body until it expires
+        logger.exception("Background refresh of %s failed", key)
+        return
+    response_cache[key] = (time.monotonic(), body)
+
+
+async def cached_body(key: str, load: Callable[[], Awaitable[BaseModel]]) -> bytes:
+    entry = response_cache.get(key)
+    if entry is None:
+        # Concurrent misses for a key wait on one load
+        async with response_locks[key]:
+            entry = response_cache.get(key)
+            if entry is None:
+                body = (await load()).model_dump_json().encode()
+                response_cache[key] = (time.monotonic(), body)
+                return body
+
+    stored_at, body = entry
+    if time.monotonic() - stored_at > RESPONSE_TTL and key not in response_refreshes:
+        refresh = asyncio.create_task(refresh_response(key, load))
+        response_refreshes[key] = refresh
+        refresh.add_done_callback(
+            lambda _: response_refreshes.pop(key, None))
+    return body
+
+
+def etag_response(request: Request, body: bytes, cache_control: str = "private, max-age=30") -> Response:
+    etag = f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+    headers = {"ETag": etag, "Cache-Control": cache_control}
+
+    if_none_match = request.headers.get("if-none-match", "")
+    client_etags = [tag.strip().removeprefix("W/")
+                    for tag in if_none_match.split(",")]
+    if etag in client_etags or "*" in client_etags:
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type="application/json", headers=headers)
+
+
+async def load_products(client: httpx.AsyncClient) -> ProductsResponse:
+    response = await conditional_get(client, PRODUCTS_PATH)
+
+    if response.status_code != 200:
+        raise HTTPException(status_code=response.status_code,
+                            detail="Failed to fetch products from Shopify")
+    # Validate straight from the response bytes rather than building a
+    # Python dict first and unpacking it into the model
+    return ProductsResponse.model_validate_json(response.content)
+
+
 @app.get("/products",)
-async def get_products():
+async def get_products(request: Request):
     if not SHOPIFY_SHOP_URL or not SHOPIFY_ACCESS_TOKEN:
         raise HTTPException(
             status_code=500, detail="Shopify credentials not configured")
 
-    headers = {
-        "X-Shopify-Access-Token": SHOPIFY_ACCESS_TOKEN,
-        "Content-Type": "application/json"
-    }
+    client = request.app.state.http
+    body = await cached_body(request.url.path, lambda: load_products(client))
+    return etag_response(request, body, LIST_CACHE_CONTROL)
 
-    async with httpx.AsyncClient() as client:
-        response = await client.get(f"{SHOPIFY_SHOP_URL}/admin/api/2023-04/products.json", headers=headers)
 
-    if response.status_code != 200:
-        raise HTTPException(status_code=response.status_code,
-                            detail="Failed to fetch products from Shopify")
-# return response.json()
-    return ProductsResponse(**response.json())
+# Shopify accepts at most 50 inventory_item_ids per inventory_levels request
+INVENTORY_BATCH_SIZE = 50
 
 
-async def fetch_inventory_levels(client: httpx.AsyncClient, variant_ids: List[int], headers: Dict[str, str]) -> Dict[int, Dict[str, int]]:
-    inventory_url = f"{
-        SHOPIFY_SHOP_URL}/admin/api/2023-04/inventory_levels.json?inventory_item_ids={','.join(map(str, variant_ids))}"
-    inventory_response = await client.get(inventory_url, headers=headers)
+async def fetch_inventory_batch(client: httpx.AsyncClient, variant_ids: Tuple[int, ...]) -> Dict[int, int]:
+    inventory_levels = {}
+    inventory_url = INVENTORY_LEVELS_PATH.format(','.join(map(str, variant_ids)))
+    # Shopify returns one level per item and location, so items stocked at
+    # several locations are summed and the batch may span several pages
+    while inventory_url is not None:
+        inventory_response = await shopify_get(client, inventory_url)
 
-    if inventory_response.status_code != 200:
-        raise HTTPException(status_code=inventory_response.status_code,
-                            detail="Failed to fetch inventory levels from Shopify")
+        if inventory_response.status_code != 200:
+            raise HTTPException(status_code=inventory_response.status_code,
+                                detail="Failed to fetch inventory levels from Shopify")
+
+        for item in orjson.loads(inventory_response.content)["inventory_levels"]:
+            inventory_item_id = item["inventory_item_id"]
+            inventory_levels[inventory_item_id] = (inventory_levels.get(inventory_item_id, 0)
+                                                   + (item["available"] or 0))
+        inventory_url = inventory_response.links.get("next", {}).get("url")
+    return inventory_levels
+
+
+async def fetch_inventory_levels(client: httpx.AsyncClient, variant_ids: Iterable[int]) -> Dict[int, int]:
+    # Batching straight off the iterable lets callers pass a generator
+    # instead of building a full list of IDs first. The batches are gathered,
+    # but each request still waits its turn in shopify_bucket.
+    results = await asyncio.gather(
+        *[fetch_inventory_batch(client, batch)
+          for batch in itertools.batched(variant_ids, INVENTORY_BATCH_SIZE)])
 
     inventory_levels = {}
-    for item in inventory_response.json()["inventory_levels"]:
-        inventory_levels[item["inventory_item_id"]] = {
-            "available": item["available"],
-            "inventory_quantity": item["available"]
-        }
+    for result in results:
+        inventory_levels.update(result)
     return inventory_levels
 
 
-@app.get("/detailed-products", response_model=DetailedProductsResponse)
-async def get_detailed_products():
-    if not SHOPIFY_SHOP_URL or not SHOPIFY_ACCESS_TOKEN:
-        raise HTTPException(
-            status_code=500, detail="Shopify credentials not configured")
+def apply_inventory_levels(products: List[dict], inventory_levels: Dict[int, int]) -> None:
+    for product in products:
+        for variant in product["variants"]:
+            quantity = inventory_levels.get(variant["inventory_item_id"], 0)
+            variant["available"] = quantity > 0
+            variant["inventory_quantity"] = quantity
 
-    headers = {
-        "X-Shopify-Access-Token": SHOPIFY_ACCESS_TOKEN,
-        "Content-Type": "application/json"
-    }
 
-    all_products = []
-    next_url = f"{SHOPIFY_SHOP_URL}/admin/api/2023-04/products.json"
+async def fetch_product(client: httpx.AsyncClient, product_id: int) -> dict:
+    response = await conditional_get(client, PRODUCT_PATH.format(product_id))
+
+    if response.status_code != 200:
+        raise HTTPException(status_code=response.status_code,
+                            detail="Failed to fetch product details from Shopify")
 
-    async with httpx.AsyncClient() as client:
-        while next_url:
-            response = await client.get(next_url, headers=headers)
-            if response.status_code != 200:
-                raise HTTPException(
-                    status_code=response.status_code, detail="Failed to fetch products from Shopify")
+    return orjson.loads(response.content)["product"]
 
-            products_data = response.json()["products"]
 
-            # Collect all variant IDs
-            all_variant_ids = [variant["inventory_item_id"]
-                               for product in products_data for variant in product["variants"]]
+async def fetch_page(client: httpx.AsyncClient, url: str) -> Tuple[List[dict], Optional[str]]:
+    response = await conditional_get(client, url)
+    if response.status_code != 200:
+        raise HTTPException(
+            status_code=response.status_code, detail="Failed to fetch products from Shopify")
+
+    return orjson.loads(response.content)["products"], response.links.get("next", {}).get("url")
 
-            # Fetch inventory levels for all variants
-            inventory_levels = await fetch_inventory_levels(client, all_variant_ids, headers)
 
-            # Process each product
-            for product in products_data:
-                for variant in product["variants"]:
-                    inventory_item_id = variant["inventory_item_id"]
-                    inventory_info = inventory_levels.get(
-                        inventory_item_id, {"available": 0, "inventory_quantity": 0})
-                    quantity = inventory_info["inventory_quantity"] or 0
+# Pages the producer may fetch ahead of the consumer
+PAGE_QUEUE_SIZE = 4
 
-                    variant["available"] = quantity > 0
-                    variant["inventory_quantity"] = quantity
-                all_products.append(ProductDetails(**product))
 
-            next_url = response.links.get("next", {}).get("url")
+async def produce_pages(client: httpx.AsyncClient, pages: asyncio.Queue) -> None:
+    url = PRODUCTS_PATH
+    while url is not None:
+        products_data, url = await fetch_page(client, url)
+        await pages.put(products_data)
+    await pages.put(None)
+
+
+async def consume_pages(client: httpx.AsyncClient, pages: asyncio.Queue) -> List[ProductDetails]:
+    all_products = []
+    while True:
+        products_data = await pages.get()
+        if products_data is None:
+            return all_products
+
+        # Collect all variant IDs
+        all_variant_ids = (variant["inventory_item_id"]
+                           for product in products_data for variant in product["variants"])
+        inventory_levels = await fetch_inventory_levels(client, all_variant_ids)
+
+        apply_inventory_levels(products_data, inventory_levels)
+        all_products.extend(product_details_list.validate_python(products_data))
+
+
+async def load_detailed_products(client: httpx.AsyncClient) -> DetailedProductsResponse:
+    # The producer follows the Link cursors on its own, so the next page is
+    # downloading while the consumer looks up inventory and validates the
+    # previous one
+    pages = asyncio.Queue(maxsize=PAGE_QUEUE_SIZE)
+    producer = asyncio.create_task(produce_pages(client, pages))
+    consumer = asyncio.create_task(consume_pages(client, pages))
+    try:
+        _, all_products = await asyncio.gather(producer, consumer)
+    except BaseException:
+        # Don't leave the other side blocked on the queue
+        producer.cancel()
+        consumer.cancel()
+        raise
 
     return DetailedProductsResponse(products=all_products)
 
 
-@app.get("/products/{product_id}", response_model=ProductDetails)
-async def get_product_details(product_id: int):
+@app.get("/detailed-products", response_model=DetailedProductsResponse)
+async def get_detailed_products(request: Request):
     if not SHOPIFY_SHOP_URL or not SHOPIFY_ACCESS_TOKEN:
         raise HTTPException(
             status_code=500, detail="Shopify credentials not configured")
 
-    headers = {
-        "X-Shopify-Access-Token": SHOPIFY_ACCESS_TOKEN,
-        "Content-Type": "application/json"
-    }
+    client = request.app.state.http
+    body = await cached_body(request.url.path, lambda: load_detailed_products(client))
+    return etag_response(request, body, LIST_CACHE_CONTROL)
 
-    url = f"{SHOPIFY_SHOP_URL}/admin/api/2023-04/products/{product_id}.json"
 
-    async with httpx.AsyncClient() as client:
-        response = await client.get(url, headers=headers)
+# A batch makes one product request per ID plus its inventory requests (one
+# per 50 variants). Capping it at 35 IDs leaves 5 inventory requests of
+# room, so a typical batch fits in one 40-request burst from an empty
+# bucket; anything beyond that is paced by shopify_bucket.
+INVENTORY_REQUEST_RESERVE = 5
+MAX_BATCH_IDS = SHOPIFY_BUCKET_SIZE - INVENTORY_REQUEST_RESERVE
 
-        if response.status_code != 200:
-            raise HTTPException(status_code=response.status_code,
-                                detail="Failed to fetch product details from Shopify")
 
-        product_data = response.json()["product"]
+@app.get("/products/batch", response_model=DetailedProductsResponse)
+async def get_products_batch(ids: str, request: Request):
+    if not SHOPIFY_SHOP_URL or not SHOPIFY_ACCESS_TOKEN:
+        raise HTTPException(
+            status_code=500, detail="Shopify credentials not configured")
 
-        # Fetch inventory levels for each variant
-        variant_ids = [variant["id"] for variant in product_data["variants"]]
-        inventory_item_ids = [variant["inventory_item_id"]
-                              for variant in product_data["variants"]]
-        inventory_url = f"{
-            SHOPIFY_SHOP_URL}/admin/api/2023-04/inventory_levels.json?inventory_item_ids={','.join(map(str, inventory_item_ids))}"
-        inventory_response = await client.get(inventory_url, headers=headers)
+    try:
+        # dict.fromkeys drops repeated IDs but keeps the requested order
+        product_ids = list(dict.fromkeys(
+            int(product_id) for product_id in ids.split(",")))
+    except ValueError:
+        raise HTTPException(
+            status_code=400, detail="ids must be a comma-separated list of product IDs")
+    if len(product_ids) > MAX_BATCH_IDS:
+        raise HTTPException(
+            status_code=400, detail=f"At most {MAX_BATCH_IDS} product IDs can be requested at once")
 
-        if inventory_response.status_code != 200:
-            raise HTTPException(status_code=inventory_response.status_code,
-                                detail="Failed to fetch inventory levels from Shopify")
+    client = request.app.state.http
+    products_data = await asyncio.gather(
+        *[fetch_product(client, product_id) for product_id in product_ids])
 
-        inventory_levels = {item["inventory_item_id"]: item["available"]
-                            for item in inventory_response.json()["inventory_levels"]}
-
-        # Update variants with availability and inventory quantity
-        for variant in product_data["variants"]:
-            inventory_item_id = variant["inventory_item_id"]
-            inventory_level = inventory_levels.get(inventory_item_id) or 0
-            variant["available"] = inventory_level > 0
-            variant["inventory_quantity"] = inventory_level
-
-        return ProductDetails(**product_data)
-
-
-def extract_product_id_from_url(url: str) -> Optional[int]:
-    # Pattern to match various forms of Shopify product URLs
-    patterns = [
-        r'/products/([^/]+)',  # Matches /products/product-handle
-        # Matches /products/product-handle/1234567890
-        r'/products/([^/]+)/(\d+)',
-        r'variant=(\d+)',  # Matches variant query parameter
-        r'product/(\d+)'  # Matches /product/1234567890
-    ]
-
-    for pattern in patterns:
-        match = re.search(pattern, url)
-        if match:
-            # If it's a numeric ID, return it
-            if match.group(1).isdigit():
-                return int(match.group(1))
-            # If it's a handle, we need to query the API to get the ID
-            else:
-                return get_product_id_from_handle(match.group(1))
+    # One inventory lookup covers the variants of every product in the batch
+    inventory_item_ids = {variant["inventory_item_id"]
+                          for product in products_data for variant in product["variants"]}
+    inventory_levels = await fetch_inventory_levels(client, inventory_item_ids)
 
-    return None
+    apply_inventory_levels(products_data, inventory_levels)
+    return DetailedProductsResponse(products=product_details_list.validate_python(products_data))
 
 
-async def get_product_id_from_handle(handle: str) -> Optional[int]:
-    headers = {
-        "X-Shopify-Access-Token": SHOPIFY_ACCESS_TOKEN,
-        "Content-Type": "application/json"
-    }
-    url = f"{SHOPIFY_SHOP_URL}/admin/api/2023-04/products.json?handle={handle}"
+async def build_product_details(client: httpx.AsyncClient, product_data: dict) -> ProductDetails:
+    inventory_item_ids = (variant["inventory_item_id"]
+                          for variant in product_data["variants"])
+    inventory_levels = await fetch_inventory_levels(client, inventory_item_ids)
 
-    async with httpx.AsyncClient() as client:
-        response = await client.get(url, headers=headers)
-        if response.status_code == 200:
-            products = response.json().get("products", [])
-            if products:
-                return products[0]["id"]
+    apply_inventory_levels([product_data], inventory_levels)
+    return ProductDetails.model_validate(product_data)
+
+
+@app.get("/products/{product_id}", response_model=ProductDetails)
+async def get_product_details(product_id: int, request: Request):
+    if not SHOPIFY_SHOP_URL or not SHOPIFY_ACCESS_TOKEN:
+        raise HTTPException(
+            status_code=500, detail="Shopify credentials not configured")
+
+    client = request.app.state.http
+    product = await build_product_details(client, await fetch_product(client, product_id))
+    return etag_response(request, product.model_dump_json().encode())
+
+
+# Pattern to match various forms of Shopify product URLs, compiled once so
+# each lookup is a single scan of the URL
+PRODUCT_URL_PATTERN = re.compile(r"""
+    /products/(?P<handle>[^/?#]+)(?:/(?P<product_id>\d+))?  # /products/product-handle[/1234567890]
+    | variant=(?P<variant_id>\d+)                           # variant query parameter
+    | product/(?P<legacy_id>\d+)                            # /product/1234567890
+""", re.VERBOSE)
+
+
+def parse_product_url(url: str) -> Tuple[Optional[int], Optional[str]]:
+    # Returns (product_id, None) when the URL carries an ID, otherwise
+    # (None, handle) so the caller can resolve the handle itself
+    match = PRODUCT_URL_PATTERN.search(url)
+    if not match:
+        return None, None
+
+    # If it's a numeric ID, return it
+    product_id = (match.group("product_id") or match.group("variant_id")
+                  or match.group("legacy_id"))
+    if product_id:
+        return int(product_id), None
+
+    handle = match.group("handle")
+    if handle.isdigit():
+        return int(handle), None
+    return None, handle
+
+
+async def lookup_handle(client: httpx.AsyncClient, handle: str) -> Optional[ProductDetails]:
+    product_id = handle_cache.get(handle)
+    if product_id is not None:
+        return await build_product_details(client, await fetch_product(client, product_id))
+
+    # The handle query already returns the full product, so there is no
+    # need to fetch it again by ID
+    response = await shopify_get(client, PRODUCTS_PATH, params={"handle": handle})
+    if response.status_code == 200:
+        products = orjson.loads(response.content).get("products", [])
+        if products:
+            handle_cache[handle] = products[0]["id"]
+            return await build_product_details(client, products[0])
     return None
 
 
+async def fetch_product_by_handle(client: httpx.AsyncClient, handle: str) -> Optional[ProductDetails]:
+    # Concurrent misses for the same handle share one lookup, inventory
+    # included, and every caller gets the finished, read-only model
+    return await single_flight(handle_lookups, handle, lambda: lookup_handle(client, handle))
+
+
 @app.get("/product-by-url")
-async def get_product_by_url(url: str):
-    product_id = extract_product_id_from_url(url)
-    if product_id is None:
+async def get_product_by_url(url: str, request: Request):
+    if not SHOPIFY_SHOP_URL or not SHOPIFY_ACCESS_TOKEN:
+        raise HTTPException(
+            status_code=500, detail="Shopify credentials not configured")
+
+    product_id, handle = parse_product_url(url)
+    if product_id is None and handle is not None:
+        product_id = handle_cache.get(handle)
+    if product_id is not None:
+        return await get_product_details(product_id, request)
+
+    client = request.app.state.http
+    product = await fetch_product_by_handle(client, handle) if handle else None
+    if product is None:
         raise HTTPException(
             status_code=400, detail="Unable to extract product ID from URL")
-    return await get_product_details(product_id)
+    return etag_response(request, product.model_dump_json().encode())
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    uvicorn.run(app, host="0.0.0.0", port=8000,
+                loop="uvloop", http="httptools")